@@ -1,8 +1,10 @@
 import logging
 import html
+import time
+import threading
 import paramiko
 import asyncio
-import nest_asyncio
+from collections import deque
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -13,9 +15,6 @@ from telegram.ext import (
 )
 from telegram.error import BadRequest, RetryAfter
 
-# Permitir anidar event loops (útil en algunos entornos)
-nest_asyncio.apply()
-
 # --- Configuración de logging ---
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -28,24 +27,23 @@ from config import SSH_HOST, SSH_PORT, SSH_USER, SSH_PASSWORD, DOCKER_PATH, BOT_
 # Variable global para la conexión SSH persistente
 ssh_client = None
 
-# Global para almacenar la información del panel principal
-main_panel_chat_id = None
-main_panel_message_id = None
-main_panel_job = None   # <-- Variable global para el job de actualización
+# Límite de canales SSH simultáneos sobre el Transport compartido,
+# por debajo del MaxSessions por defecto de sshd (10)
+_ssh_semaforo = threading.BoundedSemaphore(8)
 
-# Diccionario para almacenar los trabajos de actualización de logs
-# La clave es (chat_id, cont_id) y el valor es el job
-log_jobs = {}
+# Serializa la reconexión: los comandos corren en hilos y, si el Transport
+# cae, todos intentarían reconectar a la vez pisándose el cliente global
+_ssh_reconexion = threading.Lock()
 
 # --- Funciones de conexión SSH y comandos Docker ---
 
 def init_ssh():
     """Inicializa y establece una conexión SSH persistente sin usar ssh-agent."""
     global ssh_client
-    ssh_client = paramiko.SSHClient()
-    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    cliente = paramiko.SSHClient()
+    cliente.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     try:
-        ssh_client.connect(
+        cliente.connect(
             SSH_HOST,
             port=SSH_PORT,
             username=SSH_USER,
@@ -53,167 +51,381 @@ def init_ssh():
             allow_agent=False,
             look_for_keys=False
         )
+        # Publicar el cliente global solo tras conectar con éxito, para que
+        # otros hilos nunca vean un cliente a medio conectar
+        ssh_client = cliente
         logger.info("Conexión SSH establecida exitosamente.")
     except Exception as e:
         logger.error(f"Error al conectar vía SSH: {e}")
 
-def ejecutar_comando_ssh(comando: str):
+def _obtener_transport():
     """
-    Ejecuta un comando vía la conexión SSH persistente y retorna (salida, error).
+    Devuelve el Transport activo de la conexión persistente, reconectando
+    solo si la sesión se ha caído. Así todos los comandos multiplexan
+    canales sobre un único Transport en lugar de renegociar TCP+crypto.
     """
     global ssh_client
-    if ssh_client is None:
+    transport = ssh_client.get_transport() if ssh_client else None
+    if transport is not None and transport.is_active():
+        return transport
+    with _ssh_reconexion:
+        # Otro hilo puede haber reconectado mientras esperábamos el lock
+        transport = ssh_client.get_transport() if ssh_client else None
+        if transport is not None and transport.is_active():
+            return transport
+        logger.info("Transport SSH inactivo; reconectando.")
+        if ssh_client is not None:
+            try:
+                ssh_client.close()
+            except Exception:
+                pass
+            ssh_client = None
         init_ssh()
+        transport = ssh_client.get_transport() if ssh_client else None
+    return transport
+
+# Topes de memoria al leer la salida de un comando: se conserva solo la cola
+_MAX_SALIDA = 1024 * 1024   # 1 MiB de stdout
+_MAX_ERROR = 64 * 1024      # 64 KiB de stderr
+
+def _leer_canal_acotado(canal):
+    """
+    Lee stdout y stderr del canal en bloques de 4 KiB conservando solo la
+    cola (_MAX_SALIDA / _MAX_ERROR bytes). Así un contenedor muy verboso
+    no hace que Paramiko acumule todo el log en memoria.
+    Retorna (salida, error) como bytes.
+    """
+    salida = bytearray()
+    error = bytearray()
+    while True:
+        leyo = False
+        if canal.recv_ready():
+            salida += canal.recv(4096)
+            leyo = True
+            if len(salida) > _MAX_SALIDA:
+                del salida[:len(salida) - _MAX_SALIDA]
+        if canal.recv_stderr_ready():
+            error += canal.recv_stderr(4096)
+            leyo = True
+            if len(error) > _MAX_ERROR:
+                del error[:len(error) - _MAX_ERROR]
+        if not leyo:
+            if canal.exit_status_ready():
+                break
+            time.sleep(0.05)
+    return bytes(salida), bytes(error)
+
+def ejecutar_comando_ssh(comando: str):
+    """
+    Ejecuta un comando abriendo un canal sobre el Transport persistente
+    y retorna (salida, error, estado). El exit status del comando es lo
+    que distingue un fallo real: docker escribe avisos por stderr (y
+    'docker logs' replica ahí el stderr del contenedor) sin que eso
+    signifique que el comando fallara.
+    """
+    transport = _obtener_transport()
+    if transport is None:
+        return "", "Sin conexión SSH", -1
     try:
-        stdin, stdout, stderr = ssh_client.exec_command(comando)
-        salida = stdout.read().decode('utf-8')
-        error = stderr.read().decode('utf-8')
-        return salida, error
+        with _ssh_semaforo:
+            canal = transport.open_session()
+            try:
+                canal.exec_command(comando)
+                salida_bytes, error_bytes = _leer_canal_acotado(canal)
+                estado = canal.recv_exit_status()
+            finally:
+                canal.close()
+        salida = salida_bytes.decode('utf-8', 'replace')
+        error = error_bytes.decode('utf-8', 'replace')
+        return salida, error, estado
     except Exception as e:
         logger.error(f"Error al ejecutar el comando '{comando}': {e}")
-        return "", str(e)
+        return "", str(e), -1
+
+# Caché de StartedAt por contenedor: el ISO crudo casi nunca cambia entre
+# refrescos, así que evitamos repetir fromisoformat/strftime en cada tick
+_started_cache = {}
 
-def listar_dockers_ssh():
+async def listar_dockers_ssh():
     """
-    Lista TODOS los contenedores (activos y detenidos) usando 'docker ps -a' vía SSH.
-    Para cada contenedor se obtiene:
-      - ID, Nombre y Status (de docker ps -a)
-      - Si está corriendo ("Up"), se usa docker inspect para obtener el campo .State.StartedAt
-        y se calcula el uptime (diferencia entre ahora y ese valor) y se formatea la hora de inicio.
-      - Si está detenido, se obtiene también .State.StartedAt (última vez iniciado) y se muestra "Stopped" en uptime.
+    Lista TODOS los contenedores (activos y detenidos) con UN solo comando vía SSH.
+    En lugar de un 'docker ps -a' más un 'docker inspect' por contenedor (N+1
+    viajes de ida y vuelta), se pasa la lista de IDs a un único 'docker inspect'
+    con formato, que devuelve por línea:
+      Id|Nombre|Estado|StartedAt
+    Con eso se calcula el uptime (si está "running") o se muestra "Stopped",
+    y se formatea la hora del último arranque.
     """
-    comando = f'{DOCKER_PATH} ps -a --format "{{{{.ID}}}}|{{{{.Names}}}}|{{{{.Status}}}}"'
-    salida, error = ejecutar_comando_ssh(comando)
-    if error:
-        logger.error("Error al listar dockers: " + error)
+    comando = (
+        f'{DOCKER_PATH} ps -aq | xargs -r {DOCKER_PATH} inspect '
+        f'--format "{{{{.Id}}}}|{{{{.Name}}}}|{{{{.State.Status}}}}|{{{{.State.StartedAt}}}}"'
+    )
+    salida, error, estado = await asyncio.to_thread(ejecutar_comando_ssh, comando)
+    if not salida:
+        if estado != 0 or error:
+            logger.error("Error al listar dockers: " + (error or f"exit status {estado}"))
         return []
+    if estado != 0 or error:
+        # p.ej. un contenedor eliminado entre el ps y el inspect: inspect
+        # protesta por stderr pero imprime igualmente los que siguen vivos,
+        # así que avisamos y parseamos lo recibido en vez de descartarlo
+        logger.warning("Avisos al listar dockers: " + (error.strip() or f"exit status {estado}"))
     contenedores = []
+    now_ts = time.time()    # una sola lectura del reloj para todo el listado
     for linea in salida.splitlines():
-        partes = linea.split("|")
-        if len(partes) == 3:
-            cont_id, nombre, status = partes
-            started_at = "Unknown"
-            uptime_str = "Unknown"
-            try:
-                inspect_cmd = f'{DOCKER_PATH} inspect -f "{{{{.State.StartedAt}}}}" {cont_id}'
-                started_raw, err = ejecutar_comando_ssh(inspect_cmd)
-                if not err and started_raw.strip():
-                    started_time = datetime.fromisoformat(started_raw.strip())
+        try:
+            # split acotado + desempaquetado: sin lista de tamaño variable ni len()
+            cont_id, nombre, status, started_raw = linea.split("|", 3)
+        except ValueError:
+            continue
+        cont_id = cont_id[:12]          # ID corto, como el de 'docker ps'
+        nombre = nombre.lstrip("/")     # inspect antepone "/" al nombre
+        started_at = "Unknown"
+        uptime_str = "Unknown"
+        try:
+            started_raw = started_raw.strip()
+            if started_raw:
+                cacheado = _started_cache.get(cont_id)
+                if cacheado and cacheado[0] == started_raw:
+                    _, started_at, started_ts = cacheado
+                else:
+                    started_time = datetime.fromisoformat(started_raw)
                     started_at = started_time.strftime("%Y-%m-%d %H:%M:%S")
-                    if "Up" in status:
-                        now = datetime.now(started_time.tzinfo) if started_time.tzinfo else datetime.now()
-                        delta = now - started_time
-                        total_seconds = delta.total_seconds()
-                        if total_seconds >= 3600:
-                            hours = int(total_seconds // 3600)
-                            uptime_str = f"{hours} hours ago"
-                        else:
-                            minutes = int(total_seconds // 60)
-                            uptime_str = f"{minutes} minutes ago"
+                    started_ts = started_time.timestamp()
+                    _started_cache[cont_id] = (started_raw, started_at, started_ts)
+                if status == "running":
+                    # Aritmética de floats contra el now_ts ya leído: sin
+                    # datetime.now() ni timedelta por contenedor
+                    total_seconds = now_ts - started_ts
+                    if total_seconds >= 3600:
+                        hours = int(total_seconds // 3600)
+                        uptime_str = f"{hours} hours ago"
                     else:
-                        uptime_str = "Stopped"
-            except Exception as ex:
-                logger.error(f"Error al procesar el contenedor {cont_id}: {ex}")
-            icono = "🟢" if "Up" in status else "🔴"
-            contenedores.append({
-                "id": cont_id,
-                "nombre": nombre,
-                "status": status,
-                "uptime": uptime_str,
-                "start": started_at,
-                "icono": icono
-            })
+                        minutes = int(total_seconds // 60)
+                        uptime_str = f"{minutes} minutes ago"
+                else:
+                    uptime_str = "Stopped"
+        except Exception as ex:
+            logger.error(f"Error al procesar el contenedor {cont_id}: {ex}")
+        icono = "🟢" if status == "running" else "🔴"
+        contenedores.append({
+            "id": cont_id,
+            "nombre": nombre,
+            "status": status,
+            "uptime": uptime_str,
+            "start": started_at,
+            "icono": icono
+        })
     return contenedores
 
-def reiniciar_docker_ssh(cont_id: str):
+# Caché con TTL corto para no repetir el listado SSH en cada callback
+_dockers_cache = {"ts": 0.0, "data": []}
+
+async def listar_dockers_cached(ttl: float = 5.0):
+    """
+    Devuelve el listado de contenedores, reutilizando el resultado anterior
+    si tiene menos de 'ttl' segundos. Evita repetir el viaje SSH completo
+    en los callbacks que se disparan justo después de refrescar el panel.
+    """
+    ahora = time.monotonic()
+    if ahora - _dockers_cache["ts"] > ttl:
+        _dockers_cache["data"] = await listar_dockers_ssh()
+        _dockers_cache["ts"] = ahora
+    return _dockers_cache["data"]
+
+def invalidar_cache_dockers():
+    """Fuerza a que el próximo listado vuelva a consultar por SSH."""
+    _dockers_cache["ts"] = 0.0
+
+async def reiniciar_docker_ssh(cont_id: str):
     """Reinicia el contenedor especificado vía SSH."""
     comando = f'{DOCKER_PATH} restart {cont_id}'
-    salida, error = ejecutar_comando_ssh(comando)
-    if error:
-        return f"Error al reiniciar el contenedor {cont_id}: {error}"
+    salida, error, estado = await asyncio.to_thread(ejecutar_comando_ssh, comando)
+    if estado != 0:
+        return f"Error al reiniciar el contenedor {cont_id}: {error or salida}"
     return f"Contenedor {cont_id} reiniciado: {salida}"
 
-def obtener_log_ssh(cont_id: str, lineas=20):
-    """Obtiene las últimas 'lineas' del log del contenedor vía SSH."""
-    comando = f'{DOCKER_PATH} logs --tail {lineas} {cont_id}'
-    salida, error = ejecutar_comando_ssh(comando)
-    if error:
-        return f"Error al obtener el log: {error}"
-    return salida
+async def obtener_log_ssh(cont_id: str, lineas=20, since=None):
+    """
+    Obtiene log del contenedor vía SSH y retorna (salida, error); 'error'
+    solo llega relleno cuando el comando realmente falló (exit status
+    distinto de 0). El stderr del contenedor se redirige con 2>&1 para
+    que cuente como contenido del log y no como fallo.
+    Sin 'since' trae las últimas 'lineas'; con 'since' (timestamp unix)
+    solo los bytes nuevos desde ese instante, para el tail incremental.
+    """
+    if since is not None:
+        comando = f'{DOCKER_PATH} logs --since {since} {cont_id} 2>&1'
+    else:
+        comando = f'{DOCKER_PATH} logs --tail {lineas} {cont_id} 2>&1'
+    salida, error, estado = await asyncio.to_thread(ejecutar_comando_ssh, comando)
+    if estado != 0:
+        return salida, (error or salida or f"exit status {estado}")
+    return salida, None
 
-def stop_docker_ssh(cont_id: str):
+async def stop_docker_ssh(cont_id: str):
     """Detiene el contenedor especificado vía SSH."""
     comando = f'{DOCKER_PATH} stop {cont_id}'
-    salida, error = ejecutar_comando_ssh(comando)
-    if error:
-        return f"Error al detener el contenedor {cont_id}: {error}"
+    salida, error, estado = await asyncio.to_thread(ejecutar_comando_ssh, comando)
+    if estado != 0:
+        return f"Error al detener el contenedor {cont_id}: {error or salida}"
     return f"Contenedor {cont_id} detenido: {salida}"
 
-def start_docker_ssh(cont_id: str):
+async def start_docker_ssh(cont_id: str):
     """Inicia el contenedor especificado vía SSH."""
     comando = f'{DOCKER_PATH} start {cont_id}'
-    salida, error = ejecutar_comando_ssh(comando)
-    if error:
-        return f"Error al iniciar el contenedor {cont_id}: {error}"
+    salida, error, estado = await asyncio.to_thread(ejecutar_comando_ssh, comando)
+    if estado != 0:
+        return f"Error al iniciar el contenedor {cont_id}: {error or salida}"
     return f"Contenedor {cont_id} iniciado: {salida}"
 
 # --- Funciones del Panel Principal y Actualizaciones ---
-async def construir_mensaje_principal() -> (str, InlineKeyboardMarkup):
+
+# Cabecera constante del panel (HTML, el mismo parse_mode que los logs)
+PANEL_HEADER = "📊 <b>Contenedores Activos</b> 📊\n\n"
+
+# Caché del teclado del panel: mientras el conjunto (id, icono, nombre)
+# no cambie se reutiliza el mismo InlineKeyboardMarkup en cada refresco
+_kb_cache = {"clave": None, "teclado": None}
+async def construir_mensaje_principal(context: ContextTypes.DEFAULT_TYPE) -> (str, InlineKeyboardMarkup):
     """
     Construye el panel principal con un formato más estructurado.
     Cada contenedor se muestra en dos líneas:
       [Icono][Nombre]
        • Uptime: ⏱️ <tiempo>
        • Start: 🕒 <fecha y hora de inicio>
+    Además guarda en bot_data un diccionario {id: nombre} para que los
+    callbacks que solo necesitan el nombre no vuelvan a consultar por SSH.
+    Retorna (cuerpo, teclado); la línea "_Actualizado a las..._" la añade
+    quien envía/edita, para que el cuerpo sea comparable entre refrescos.
     """
-    contenedores = listar_dockers_ssh()
-    mensaje = "📊 *Contenedores Activos* 📊\n\n"
+    contenedores = await listar_dockers_cached()
+    context.bot_data["nombres"] = {cont["id"]: cont["nombre"] for cont in contenedores}
+    partes = [PANEL_HEADER]
     if not contenedores:
-        mensaje += "⚠️ No se encontraron contenedores activos."
+        partes.append("⚠️ No se encontraron contenedores activos.")
+    else:
+        partes.extend(
+            f"{cont['icono']} <b>{html.escape(cont['nombre'])}</b>\n"
+            f"   • Uptime: ⏱️ {cont['uptime']}\n"
+            f"   • Start: 📅 {cont['start']}\n"
+            for cont in contenedores
+        )
+    mensaje = "".join(partes)
+
+    # Construir (o reutilizar) el teclado de botones para cada contenedor
+    clave = tuple((cont['id'], cont['icono'], cont['nombre']) for cont in contenedores)
+    if clave == _kb_cache["clave"]:
+        teclado = _kb_cache["teclado"]
     else:
+        filas = []
         for cont in contenedores:
-            mensaje += f"{cont['icono']} *{cont['nombre']}*\n"
-            mensaje += f"   • Uptime: ⏱️ {cont['uptime']}\n"
-            mensaje += f"   • Start: 📅 {cont['start']}\n"
+            filas.append([InlineKeyboardButton(f"{cont['icono']} {cont['nombre']}", callback_data=f"c|{cont['id']}")])
+
+        # Agregar el botón para detener el panel principal
+        filas.append([InlineKeyboardButton("🛑 Parar bot", callback_data="stop_main_panel")])
+
+        teclado = InlineKeyboardMarkup(filas)
+        _kb_cache["clave"] = clave
+        _kb_cache["teclado"] = teclado
+
+    return mensaje, teclado
+
+def pie_actualizacion() -> str:
+    """Línea final del panel con la hora del último refresco real."""
     hora_actual = datetime.now().strftime("%H:%M:%S")
-    mensaje += f"\n_Actualizado a las {hora_actual}_"
-    
-    # Construir el teclado de botones para cada contenedor
-    teclado = []
-    for cont in contenedores:
-        teclado.append([InlineKeyboardButton(f"{cont['icono']} {cont['nombre']}", callback_data=f"container_{cont['id']}")])
-    
-    # Agregar el botón para detener el panel principal
-    teclado.append([InlineKeyboardButton("🛑 Parar bot", callback_data="stop_main_panel")])
-    
-    return mensaje, InlineKeyboardMarkup(teclado)
+    return f"\n<i>Actualizado a las {hora_actual}</i>"
+
+def huella_panel(mensaje: str, teclado: InlineKeyboardMarkup) -> int:
+    """Hash del contenido material del panel (cuerpo + botones)."""
+    botones = "".join(
+        boton.callback_data for fila in teclado.inline_keyboard for boton in fila
+    )
+    return hash(mensaje + botones)
+
+class ChatRateLimiter:
+    """
+    Limitador de ritmo por chat: garantiza al menos 'intervalo' segundos
+    entre ediciones de mensajes en el mismo chat, que es aproximadamente
+    lo que tolera Telegram (~1 edición/seg/chat) antes de responder 429.
+    """
+    def __init__(self, intervalo: float = 1.0):
+        self.intervalo = intervalo
+        self._proximo = {}   # chat_id -> instante monotónico del próximo hueco
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, chat_id):
+        """Espera hasta que el chat tenga un hueco libre y lo reserva."""
+        while True:
+            async with self._lock:
+                ahora = time.monotonic()
+                proximo = self._proximo.get(chat_id, 0.0)
+                if ahora >= proximo:
+                    self._proximo[chat_id] = ahora + self.intervalo
+                    return
+                espera = proximo - ahora
+            await asyncio.sleep(espera)
+
+    def penalizar(self, chat_id, segundos: float):
+        """Tras un RetryAfter, bloquea las ediciones del chat ese tiempo."""
+        self._proximo[chat_id] = time.monotonic() + segundos
+
+# Limitador compartido por el panel principal y los mensajes de log
+edit_limiter = ChatRateLimiter()
 
 async def update_main_panel(context: ContextTypes.DEFAULT_TYPE):
-    global main_panel_chat_id, main_panel_message_id, main_panel_job
-    if main_panel_chat_id and main_panel_message_id:
-        mensaje, teclado = await construir_mensaje_principal()
+    # El estado del panel (chat, mensaje, job y último hash) vive en el
+    # chat_data del chat que lanzó /start, no en globales del módulo
+    panel = context.chat_data.get("panel")
+    if panel:
+        mensaje, teclado = await construir_mensaje_principal(context)
+        huella = huella_panel(mensaje, teclado)
+        if huella == panel.get("hash"):
+            # Nada material cambió: ahorramos la llamada a editMessageText
+            return
         try:
+            await edit_limiter.acquire(panel["chat_id"])
             await context.bot.edit_message_text(
-                chat_id=main_panel_chat_id,
-                message_id=main_panel_message_id,
-                text=mensaje,
+                chat_id=panel["chat_id"],
+                message_id=panel["message_id"],
+                text=mensaje + pie_actualizacion(),
                 reply_markup=teclado,
-                parse_mode="Markdown"
+                parse_mode="HTML"
             )
+            panel["hash"] = huella
         except RetryAfter as e:
             logger.warning(f"Flood control exceeded. Retrying after {e.retry_after} seconds.")
-            await asyncio.sleep(e.retry_after)
+            edit_limiter.penalizar(panel["chat_id"], e.retry_after)
         except BadRequest as e:
             # Capturamos ambos mensajes de error: "Message to edit not found" y "Not found"
             if "Message to edit not found" in str(e) or "Not found" in str(e):
                 logger.info("El mensaje a editar no se encuentra. Cancelando la actualización.")
-                if main_panel_job:
-                    main_panel_job.schedule_removal()
+                context.job.schedule_removal()
+                context.chat_data.pop("panel", None)
             elif "Message is not modified" in str(e):
                 pass
             else:
                 raise e
 
+async def _borrar_despues(bot, chat_id, message_id, delay=5):
+    """Espera 'delay' segundos y borra el mensaje indicado."""
+    await asyncio.sleep(delay)
+    await bot.delete_message(chat_id=chat_id, message_id=message_id)
+
+def _programar_borrado(bot, chat_id, message_id, delay=5):
+    """
+    Lanza el borrado diferido como tarea de asyncio (más ligero que un
+    job del JobQueue para un simple sleep+delete) y registra cualquier
+    error al finalizar para que la tarea no muera en silencio.
+    """
+    tarea = asyncio.create_task(_borrar_despues(bot, chat_id, message_id, delay))
+
+    def _registrar_error(t):
+        if not t.cancelled() and t.exception():
+            logger.error("Error al borrar mensaje diferido: %s", t.exception())
+
+    tarea.add_done_callback(_registrar_error)
+
 async def stop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Detiene el contenedor seleccionado.
@@ -222,20 +434,16 @@ async def stop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     await query.delete_message()  # Elimina el mensaje de acciones
-    cont_id = query.data.split("_")[1]
-    contenedores = listar_dockers_ssh()
-    container_info = next((cont for cont in contenedores if cont["id"] == cont_id), None)
-    nombre = container_info["nombre"] if container_info else cont_id
-    resultado = stop_docker_ssh(cont_id)
+    cont_id = query.data[2:]
+    nombre = context.bot_data.get("nombres", {}).get(cont_id, cont_id)
+    resultado = await stop_docker_ssh(cont_id)
+    invalidar_cache_dockers()
     confirmation_text = f"🛑 Contenedor {nombre} detenido correctamente."
     confirmation = await context.bot.send_message(
          chat_id=update.effective_chat.id, 
          text=confirmation_text
     )
-    context.job_queue.run_once(
-         lambda ctx: ctx.bot.delete_message(chat_id=update.effective_chat.id, message_id=confirmation.message_id),
-         when=5
-    )
+    _programar_borrado(context.bot, update.effective_chat.id, confirmation.message_id)
 
 async def start_container_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -245,20 +453,16 @@ async def start_container_callback(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     await query.answer()
     await query.delete_message()
-    cont_id = query.data.split("_")[1]
-    contenedores = listar_dockers_ssh()
-    container_info = next((cont for cont in contenedores if cont["id"] == cont_id), None)
-    nombre = container_info["nombre"] if container_info else cont_id
-    resultado = start_docker_ssh(cont_id)
+    cont_id = query.data[2:]
+    nombre = context.bot_data.get("nombres", {}).get(cont_id, cont_id)
+    resultado = await start_docker_ssh(cont_id)
+    invalidar_cache_dockers()
     confirmation_text = f"🚀 Contenedor {nombre} iniciado correctamente."
     confirmation = await context.bot.send_message(
          chat_id=update.effective_chat.id, 
          text=confirmation_text
     )
-    context.job_queue.run_once(
-         lambda ctx: ctx.bot.delete_message(chat_id=update.effective_chat.id, message_id=confirmation.message_id),
-         when=5
-    )
+    _programar_borrado(context.bot, update.effective_chat.id, confirmation.message_id)
 
 async def restart_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -269,38 +473,69 @@ async def restart_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     await query.delete_message()
-    cont_id = query.data.split("_")[1]
-    reinicio_resultado = reiniciar_docker_ssh(cont_id)
-    contenedores = listar_dockers_ssh()
-    container_info = next((cont for cont in contenedores if cont["id"] == cont_id), None)
-    nombre = container_info["nombre"] if container_info else cont_id
+    cont_id = query.data[2:]
+    nombre = context.bot_data.get("nombres", {}).get(cont_id, cont_id)
+    reinicio_resultado = await reiniciar_docker_ssh(cont_id)
+    invalidar_cache_dockers()
     confirmation_text = f"✅ Contenedor *{nombre}* reiniciado correctamente."
     confirmation = await context.bot.send_message(
         chat_id=update.effective_chat.id, 
         text=confirmation_text
     )
-    context.job_queue.run_once(
-        lambda ctx: ctx.bot.delete_message(chat_id=update.effective_chat.id, message_id=confirmation.message_id),
-        when=5
-    )
+    _programar_borrado(context.bot, update.effective_chat.id, confirmation.message_id)
+
+def _extender_sin_solape(buffer, lineas):
+    """
+    Añade 'lineas' al anillo descartando el solape con su cola. El --since
+    del siguiente tick se toma antes de ejecutar el comando remoto y
+    truncado a segundos, así que las líneas de esa ventana llegan
+    repetidas en el tick siguiente; aquí se eliminan antes de acumular.
+    """
+    if not lineas:
+        return
+    existentes = list(buffer)
+    for k in range(min(len(existentes), len(lineas)), 0, -1):
+        if existentes[-k:] == lineas[:k]:
+            lineas = lineas[k:]
+            break
+    buffer.extend(lineas)
 
 async def update_log(context: ContextTypes.DEFAULT_TYPE):
     """
-    Actualiza el mensaje de log del contenedor cada 10 segundos.
+    Actualiza el mensaje de log del contenedor de forma incremental:
+    la primera pasada trae las últimas líneas con --tail y las siguientes
+    solo los bytes nuevos con --since, acumulando en un anillo de líneas.
+    Solo se edita el mensaje cuando el contenido realmente cambió.
     Se incluye un botón "🗑 Eliminar" para detener el seguimiento.
     """
     job_data = context.job.data
     chat_id = job_data['chat_id']
     message_id = job_data['message_id']
     cont_id = job_data['cont_id']
-    raw_log = obtener_log_ssh(cont_id)
-    max_chars = 4000
-    if len(raw_log) > max_chars:
-        raw_log = raw_log[-max_chars:]
-    import html
+    buffer = job_data.setdefault('buffer', deque(maxlen=50))
+    ahora_ts = int(time.time())
+    raw_nuevo, error = await obtener_log_ssh(cont_id, since=job_data.get('last_ts'))
+    if error:
+        # Fallo al obtener el log: no contaminamos el anillo con el texto
+        # del error ni avanzamos last_ts, así el próximo tick recupera las
+        # líneas emitidas durante el hueco
+        logger.error(f"Error al obtener el log de {cont_id}: {error}")
+        return
+    job_data['last_ts'] = ahora_ts
+    _extender_sin_solape(buffer, raw_nuevo.splitlines())
+    raw_log = "\n".join(buffer)
+    huella = hash(raw_log)
+    if huella == job_data.get('last_hash'):
+        # Sin líneas nuevas: ahorramos la edición completa
+        return
+    # Escapar primero y truncar después por BYTES UTF-8: el escape expande
+    # el texto y el límite de 4096 de Telegram se mide en bytes, no en
+    # caracteres, así que cortar antes podía pasarse del tope igualmente
     log_text = html.escape(raw_log)
-    botones = [[InlineKeyboardButton("🗑 Eliminar", callback_data=f"deleteLog_{cont_id}")]]
+    log_text = log_text.encode("utf-8")[-3900:].decode("utf-8", "ignore")
+    botones = [[InlineKeyboardButton("🗑 Eliminar", callback_data=f"d|{cont_id}")]]
     try:
+        await edit_limiter.acquire(chat_id)
         await context.bot.edit_message_text(
             chat_id=chat_id,
             message_id=message_id,
@@ -308,41 +543,45 @@ async def update_log(context: ContextTypes.DEFAULT_TYPE):
             reply_markup=InlineKeyboardMarkup(botones),
             parse_mode="HTML"
         )
+        job_data['last_hash'] = huella
     except RetryAfter as e:
         logger.warning(f"Flood control exceeded in update_log. Retrying after {e.retry_after} seconds.")
-        await asyncio.sleep(e.retry_after)
+        edit_limiter.penalizar(chat_id, e.retry_after)
     except BadRequest as e:
         if "Message is not modified" in str(e):
             pass
+        elif "not found" in str(e).lower():
+            # El mensaje de log ya no existe (p.ej. historial borrado):
+            # cancelamos el job para no seguir tirando de SSH para siempre
+            logger.info(f"El mensaje de log de {cont_id} no se encuentra. Cancelando el seguimiento.")
+            context.job.schedule_removal()
+            context.chat_data.get("log_jobs", {}).pop(cont_id, None)
         else:
             raise e
 
 async def log_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Al pulsar "Ver log", elimina el mensaje de acciones y envía un mensaje con el log que se actualiza cada 10 segundos.
+    Al pulsar "Ver log", elimina el mensaje de acciones y envía un mensaje con el log que se actualiza cada 15 segundos.
+    El contenido lo rellena la primera pasada de update_log (first=0),
+    así se evita un viaje SSH duplicado al abrir el log.
     """
     query = update.callback_query
     await query.answer()
     await query.delete_message()
-    cont_id = query.data.split("_")[1]
-    raw_log = obtener_log_ssh(cont_id)
-    max_chars = 4000
-    if len(raw_log) > max_chars:
-        raw_log = raw_log[-max_chars:]
-    log_text = html.escape(raw_log)
-    botones = [[InlineKeyboardButton("🗑 Eliminar", callback_data=f"deleteLog_{cont_id}")]]
+    cont_id = query.data[2:]
+    botones = [[InlineKeyboardButton("🗑 Eliminar", callback_data=f"d|{cont_id}")]]
     chat_id = update.effective_chat.id
     sent_log_msg = await context.bot.send_message(
         chat_id=chat_id,
-        text=f"Log del contenedor {cont_id}:\n\n<pre>{log_text}</pre>",
+        text=f"Log del contenedor {cont_id}:\n\n<pre>Cargando log...</pre>",
         reply_markup=InlineKeyboardMarkup(botones),
         parse_mode="HTML"
     )
     job = context.job_queue.run_repeating(
-        update_log, interval=10, first=0,
+        update_log, interval=15, first=0, chat_id=chat_id,
         data={'chat_id': chat_id, 'message_id': sent_log_msg.message_id, 'cont_id': cont_id}
     )
-    log_jobs[(chat_id, cont_id)] = job
+    context.chat_data.setdefault("log_jobs", {})[cont_id] = job
 
 async def delete_log_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -351,11 +590,11 @@ async def delete_log_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     """
     query = update.callback_query
     await query.answer("Seguimiento de log detenido")
-    cont_id = query.data.split("_")[1]
+    cont_id = query.data[2:]
     chat_id = update.effective_chat.id
-    key = (chat_id, cont_id)
-    if key in log_jobs:
-        job = log_jobs.pop(key)
+    log_jobs = context.chat_data.get("log_jobs", {})
+    if cont_id in log_jobs:
+        job = log_jobs.pop(cont_id)
         job.schedule_removal()
     try:
         await context.bot.delete_message(chat_id=chat_id, message_id=query.message.message_id)
@@ -368,22 +607,20 @@ async def stop_main_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Al pulsar el botón "🛑 Parar bot" en el panel principal,
     se cancela el job de actualización y se elimina el mensaje.
     """
-    global main_panel_chat_id, main_panel_message_id, main_panel_job
     query = update.callback_query
     await query.answer("Actualización detenida")
-    if main_panel_job:
-        main_panel_job.schedule_removal()
-        main_panel_job = None
+    panel = context.chat_data.pop("panel", None)
+    if panel is None:
+        return
+    if panel.get("job"):
+        panel["job"].schedule_removal()
     try:
         await context.bot.delete_message(
-            chat_id=main_panel_chat_id, 
-            message_id=main_panel_message_id
+            chat_id=panel["chat_id"],
+            message_id=panel["message_id"]
         )
     except Exception as e:
         logger.error("Error al eliminar el panel principal: " + str(e))
-    # Reiniciar las variables globales
-    main_panel_chat_id = None
-    main_panel_message_id = None
 
 # --- Handlers del Bot ---
 MY_CHAT_ID = 6501204809
@@ -396,20 +633,23 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Opcional: enviar mensaje de no autorizado o simplemente no hacer nada
         await update.message.reply_text("No estás autorizado para usar este bot.")
         return
-    global main_panel_chat_id, main_panel_message_id, main_panel_job
-    mensaje, teclado = await construir_mensaje_principal()
+    mensaje, teclado = await construir_mensaje_principal(context)
     sent_msg = await update.message.reply_text(
-        text=mensaje, 
-        reply_markup=teclado, 
-        parse_mode="Markdown"
+        text=mensaje + pie_actualizacion(),
+        reply_markup=teclado,
+        parse_mode="HTML"
     )
-    main_panel_chat_id = sent_msg.chat.id
-    main_panel_message_id = sent_msg.message_id
-    # Programa la actualización del panel principal cada 10 segundos y guarda el job
-    main_panel_job = context.job_queue.run_repeating(
-        update_main_panel, interval=10, first=0,
-        data={'chat_id': main_panel_chat_id, 'message_id': main_panel_message_id}
+    # Programa la actualización del panel principal cada 10 segundos y
+    # guarda todo el estado del panel en el chat_data de este chat
+    job = context.job_queue.run_repeating(
+        update_main_panel, interval=10, first=0, chat_id=sent_msg.chat.id
     )
+    context.chat_data["panel"] = {
+        "chat_id": sent_msg.chat.id,
+        "message_id": sent_msg.message_id,
+        "job": job,
+        "hash": huella_panel(mensaje, teclado)
+    }
     # Borra el mensaje original del comando /start para dejar solo el panel principal
     try:
         await update.message.delete()
@@ -424,20 +664,20 @@ async def container_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """
     query = update.callback_query
     await query.answer()
-    cont_id = query.data.split("_")[1]
-    contenedores = listar_dockers_ssh()
+    cont_id = query.data[2:]
+    contenedores = await listar_dockers_cached()
     docker_info = next((c for c in contenedores if c['id'] == cont_id), None)
     if not docker_info:
         await query.message.reply_text("No se encontró información para ese contenedor.")
         return
     botones = [
        [
-         InlineKeyboardButton("🔄 Reiniciar", callback_data=f"restart_{cont_id}"),
-         InlineKeyboardButton("📜 Ver log", callback_data=f"log_{cont_id}")
+         InlineKeyboardButton("🔄 Reiniciar", callback_data=f"r|{cont_id}"),
+         InlineKeyboardButton("📜 Ver log", callback_data=f"l|{cont_id}")
        ],
        [
-         InlineKeyboardButton("🛑 Parar", callback_data=f"stop_{cont_id}"),
-         InlineKeyboardButton("🚀 Iniciar", callback_data=f"start_{cont_id}")
+         InlineKeyboardButton("🛑 Parar", callback_data=f"p|{cont_id}"),
+         InlineKeyboardButton("🚀 Iniciar", callback_data=f"i|{cont_id}")
        ]
     ]
     await query.message.reply_text(
@@ -445,45 +685,26 @@ async def container_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
          reply_markup=InlineKeyboardMarkup(botones)
     )
 
-async def restart_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """
-    Reinicia el contenedor seleccionado.
-    """
-    query = update.callback_query
-    await query.answer()
-    await query.delete_message()
-    cont_id = query.data.split("_")[1]
-    reinicio_resultado = reiniciar_docker_ssh(cont_id)
-    contenedores = listar_dockers_ssh()
-    container_info = next((cont for cont in contenedores if cont["id"] == cont_id), None)
-    nombre = container_info["nombre"] if container_info else cont_id
-    confirmation_text = f"✅ Contenedor *{nombre}* reiniciado correctamente."
-    confirmation = await context.bot.send_message(
-        chat_id=update.effective_chat.id, 
-        text=confirmation_text
-    )
-    context.job_queue.run_once(
-        lambda ctx: ctx.bot.delete_message(chat_id=update.effective_chat.id, message_id=confirmation.message_id),
-        when=5
-    )
-
 # --- Función principal y ejecución del Bot ---
-async def main():
+def main():
     init_ssh()
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Procesar hasta 32 updates en paralelo: un callback bloqueado en SSH
+    # ya no retrasa al resto
+    app = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(32).build()
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(stop_callback, pattern="^stop_"))
-    app.add_handler(CallbackQueryHandler(start_container_callback, pattern="^start_"))
-    app.add_handler(CallbackQueryHandler(container_callback, pattern="^container_"))
-    app.add_handler(CallbackQueryHandler(restart_callback, pattern="^restart_"))
-    app.add_handler(CallbackQueryHandler(log_callback, pattern="^log_"))
-    app.add_handler(CallbackQueryHandler(delete_log_callback, pattern="^deleteLog_"))
+    app.add_handler(CallbackQueryHandler(stop_callback, pattern=r"^p\|"))
+    app.add_handler(CallbackQueryHandler(start_container_callback, pattern=r"^i\|"))
+    app.add_handler(CallbackQueryHandler(container_callback, pattern=r"^c\|"))
+    app.add_handler(CallbackQueryHandler(restart_callback, pattern=r"^r\|"))
+    app.add_handler(CallbackQueryHandler(log_callback, pattern=r"^l\|", block=False))
+    app.add_handler(CallbackQueryHandler(delete_log_callback, pattern=r"^d\|"))
     # Handler para detener el panel principal
     app.add_handler(CallbackQueryHandler(stop_main_panel, pattern="^stop_main_panel$"))
-    await app.run_polling()
+    # run_polling gestiona su propio event loop (PTB v20)
+    app.run_polling()
     if ssh_client:
         ssh_client.close()
         logger.info("Conexión SSH cerrada.")
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()